@@ -6,13 +6,14 @@ from components.customer import (
     edit_customer, delete_customer, add_combo_to_existing_customer, remove_combo_from_customer, export_customers_to_csv
 )
 from components.combo import (
-    add_combo_type, get_combo_types, delete_combo_type, get_customer_combos, add_combo, get_services_for_combo
+    add_combo_type, get_combo_types, delete_combo_type, get_customer_combos, add_combo, get_services_for_combo,
+    backup_db, restore_db
 )
 from components.appointment import (
     book_appointment, get_customer_appointments, get_appointment_by_date, delete_appointment, edit_appointment
 )
 from components.notifications import (
-    send_appointment_confirmation, send_appointment_cancellation
+    send_appointment_cancellation
 )
 
 # Set the title of the app
@@ -214,20 +215,9 @@ elif choice == "Appointment Management":
                 st.warning("No available combos for this customer.")
 
         if st.button("Book Appointment"):
+            # book_appointment also emails the confirmation if the customer has an email
             if book_appointment(customer["ID"], selected_service_id, str(date), use_combo=True, combo_id=selected_combo_id):
                 st.success(f"Appointment booked for {customer['Name']} on {date} with service {selected_service}!")
-                
-                # Send email confirmation if customer has an email
-                if customer["Email"]:
-                    send_appointment_confirmation(
-                        customer["ID"], # Pass customer ID
-                        customer["Name"],
-                        customer["Email"],
-                        selected_service,
-                        date,
-                        selected_combo_id #pass the booked combo ID
-                    )
-                
                 st.rerun()
             else:
                 st.error("Failed to book appointment.")
@@ -305,15 +295,20 @@ if choice == "Download Data":
     st.subheader("Database Backup")
     st.write("Click the button below to download a backup of the entire database. Use this backup to restore data if needed.")
     try:
-        with open("database/business.db", "rb") as db_file:
-            st.download_button(
-                label="Download Database Backup",
-                data=db_file,
-                file_name="business_backup.db",
-                mime="application/octet-stream"
-            )
-    except FileNotFoundError:
-        st.error("Database file not found. Please ensure the file 'database/business.db' exists.")
+        import os
+        import tempfile
+        # Snapshot the live database instead of reading the file it is writing to
+        with tempfile.TemporaryDirectory() as backup_dir:
+            backup_file = os.path.join(backup_dir, "business_backup.db")
+            backup_db(backup_file)
+            with open(backup_file, "rb") as db_file:
+                backup_data = db_file.read()
+        st.download_button(
+            label="Download Database Backup",
+            data=backup_data,
+            file_name="business_backup.db",
+            mime="application/octet-stream"
+        )
     except Exception as e:
         st.error(f"An error occurred while backing up the database: {e}")
 
@@ -331,18 +326,22 @@ if choice == "Download Data":
         if st.button("Restore Database"):
             # Optional: Backup current database before overwriting (for extra safety)
             try:
-                import shutil
                 backup_path = "database/business_backup_before_restore.db"
-                shutil.copyfile("database/business.db", backup_path)
+                backup_db(backup_path)
                 st.info("A backup of the current database was saved as 'business_backup_before_restore.db'.")
             except Exception as backup_error:
                 st.warning(f"Could not backup the current database before restore: {backup_error}")
 
             try:
-                # Overwrite the current database file with the uploaded backup
-                with open("database/business.db", "wb") as f:
-                    f.write(uploaded_file.getbuffer())
-                st.success("Database restored successfully! Please restart the app for changes to take effect.")
+                import os
+                import tempfile
+                # Copy the uploaded backup into the live database rather than overwriting the open file
+                with tempfile.TemporaryDirectory() as upload_dir:
+                    upload_path = os.path.join(upload_dir, "upload.db")
+                    with open(upload_path, "wb") as f:
+                        f.write(uploaded_file.getbuffer())
+                    restore_db(upload_path)
+                st.success("Database restored successfully!")
             except Exception as e:
                 st.error(f"Error restoring database: {e}")
 
@@ -1,63 +1,66 @@
+import logging
 import sqlite3
-from components.combo import update_combo_usage, get_customer_combos, get_db_connection
-from components.customer import get_customer_by_phone
+from components.combo import (
+    update_combo_usage_and_fetch, get_customer_combos, invalidate_customer_combos, read_conn, write_conn
+)
 from components.notifications import send_appointment_confirmation, send_appointment_cancellation
 
+logger = logging.getLogger(__name__)
+
 # ============================
 # Appointment Management
 # ============================
 
 def book_appointment(customer_id, service_id, date, use_combo=False, combo_id=None):
     """Books an appointment for a customer and optionally links it to a combo."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
     try:
-        # Ensure the combo is valid if using it
-        if use_combo and combo_id:
-            cursor.execute("SELECT remaining_uses FROM combos WHERE id = ? AND remaining_uses > 0", (combo_id,))
-            combo = cursor.fetchone()
-            if not combo:
-                print(f"Error: Combo ID {combo_id} is not valid or has no remaining uses.")
-                return False
+        with write_conn() as conn:
+            cursor = conn.cursor()
 
-        # Insert appointment into the database
-        cursor.execute(
-            "INSERT INTO appointments (customer_id, service_id, date, combo_id) VALUES (?, ?, ?, ?)",
-            (customer_id, service_id, date, combo_id if use_combo else None)
-        )
+            # Insert appointment into the database
+            cursor.execute(
+                "INSERT INTO appointments (customer_id, service_id, date, combo_id) VALUES (?, ?, ?, ?)",
+                (customer_id, service_id, date, combo_id if use_combo else None)
+            )
 
-        # If using a combo, decrement remaining uses using the **same** connection
-        if use_combo and combo_id:
-            update_combo_usage(combo_id, conn)  # Pass the same connection
-
-        # Fetch updated remaining uses AFTER updating combo
-        remaining_uses = None
-        if use_combo and combo_id:
-            cursor.execute("SELECT remaining_uses FROM combos WHERE id = ?", (combo_id,))
-            updated_combo = cursor.fetchone()
-            remaining_uses = updated_combo["remaining_uses"] if updated_combo else None
-
-        # Fetch customer details
-        customer = get_customer_by_phone(customer_id)
-
-        conn.commit()
-
-        if customer and customer["Email"]:  # Ensure email exists before sending
-            send_appointment_confirmation(
-                customer["Name"],
-                customer["Email"],
-                service_id,
-                date,
-                remaining_uses
+            # If using a combo, decrement remaining uses using the **same** connection
+            # and read the customer's updated combos for the confirmation email.
+            # The decrement only matches a valid combo with uses left, so it doubles as the validity check.
+            combos = None
+            if use_combo and combo_id:
+                updated, combos = update_combo_usage_and_fetch(combo_id, customer_id, conn)  # Pass the same connection
+                if not updated:
+                    return False  # Already reported; rolls back the appointment insert
+
+            # Fetch customer details
+            cursor.execute(
+                """SELECT c.name, c.email, s.name AS service
+                   FROM customers c, services s
+                   WHERE c.id = ? AND s.id = ?""",
+                (customer_id, service_id)
             )
+            customer = cursor.fetchone()
 
-        print(f"Appointment booked for Customer ID {customer_id} on {date} (Service ID {service_id}).")
-        return True
+            conn.commit()
+            invalidate_customer_combos(customer_id)
     except Exception as e:
         print(f"Error booking appointment: {e}")
         return False
-    finally:
-        conn.close()
+
+    # Send the confirmation once the database writer is released
+    if customer and customer["email"]:  # Ensure email exists before sending
+        send_appointment_confirmation(
+            customer_id,
+            customer["name"],
+            customer["email"],
+            customer["service"],
+            date,
+            combo_id,
+            combos=combos
+        )
+
+    print(f"Appointment booked for Customer ID {customer_id} on {date} (Service ID {service_id}).")
+    return True
 
 
 def get_customer_appointments(customer_id):
@@ -70,29 +73,27 @@ def get_customer_appointments(customer_id):
     Returns:
         list: List of structured appointments.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
     try:
-        cursor.execute(
-            """SELECT a.id, c.name, c.phone, s.name AS service, a.date, a.combo_id
-               FROM appointments a
-               JOIN customers c ON a.customer_id = c.id
-               JOIN services s ON a.service_id = s.id
-               WHERE a.customer_id = ? 
-               ORDER BY a.date""",
-            (customer_id,)
-        )
-        appointments = cursor.fetchall()
-        return [
-            {"ID": appt["id"], "Name": appt["name"], "Phone": appt["phone"],
-             "Service": appt["service"], "Date": appt["date"], "Combo ID": appt["combo_id"]}
-            for appt in appointments
-        ]
+        with read_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """SELECT a.id, c.name, c.phone, s.name AS service, a.date, a.combo_id
+                   FROM appointments a
+                   JOIN customers c ON a.customer_id = c.id
+                   JOIN services s ON a.service_id = s.id
+                   WHERE a.customer_id = ? 
+                   ORDER BY a.date""",
+                (customer_id,)
+            )
+            appointments = cursor.fetchall()
+            return [
+                {"ID": appt["id"], "Name": appt["name"], "Phone": appt["phone"],
+                 "Service": appt["service"], "Date": appt["date"], "Combo ID": appt["combo_id"]}
+                for appt in appointments
+            ]
     except Exception as e:
         print(f"Error retrieving appointments: {e}")
         return []
-    finally:
-        conn.close()
 
 def get_appointment_by_date(date):
     """
@@ -104,96 +105,87 @@ def get_appointment_by_date(date):
     Returns:
         list: List of structured appointments.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
     try:
-        cursor.execute(
-            """SELECT a.id, c.name, c.phone, s.name AS service, a.date, a.combo_id
-               FROM appointments a
-               JOIN customers c ON a.customer_id = c.id
-               JOIN services s ON a.service_id = s.id
-               WHERE a.date = ?
-               ORDER BY a.date""",
-            (date,)
-        )
-        appointments = cursor.fetchall()
-        return [
-            {"ID": appt["id"], "Name": appt["name"], "Phone": appt["phone"],
-             "Service": appt["service"], "Date": appt["date"], "Combo ID": appt["combo_id"]}
-            for appt in appointments
-        ]
+        with read_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """SELECT a.id, c.name, c.phone, s.name AS service, a.date, a.combo_id
+                   FROM appointments a
+                   JOIN customers c ON a.customer_id = c.id
+                   JOIN services s ON a.service_id = s.id
+                   WHERE a.date = ?
+                   ORDER BY a.date""",
+                (date,)
+            )
+            appointments = cursor.fetchall()
+            return [
+                {"ID": appt["id"], "Name": appt["name"], "Phone": appt["phone"],
+                 "Service": appt["service"], "Date": appt["date"], "Combo ID": appt["combo_id"]}
+                for appt in appointments
+            ]
     except Exception as e:
         print(f"Error retrieving appointments by date: {e}")
         return []
-    finally:
-        conn.close()
 
 def delete_appointment(appointment_id):
     """Deletes an appointment by its ID, restores combo usage if applicable, and sends a cancellation email."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
     try:
-        # Retrieve combo_id, customer_id, service name, and appointment date before deleting the appointment
-        cursor.execute("""
-            SELECT a.customer_id, c.name, c.email, s.name AS service, a.date, a.combo_id 
-            FROM appointments a
-            JOIN customers c ON a.customer_id = c.id
-            JOIN services s ON a.service_id = s.id
-            WHERE a.id = ?
-        """, (appointment_id,)
-        )
+        with write_conn() as conn:
+            cursor = conn.cursor()
+            # Retrieve combo_id, customer_id, service name, and appointment date before deleting the appointment
+            cursor.execute("""
+                SELECT a.customer_id, c.name, c.email, s.name AS service, a.date, a.combo_id 
+                FROM appointments a
+                JOIN customers c ON a.customer_id = c.id
+                JOIN services s ON a.service_id = s.id
+                WHERE a.id = ?
+            """, (appointment_id,)
+            )
 
-        result = cursor.fetchone()
+            result = cursor.fetchone()
 
-        if not result:
-            print(f"Error: Appointment ID {appointment_id} not found.")
-            return False
+            if not result:
+                print(f"Error: Appointment ID {appointment_id} not found.")
+                return False
 
-        combo_id = result["combo_id"]
-        customer_id = result["customer_id"]
-        customer_name = result["name"]
-        customer_email = result["email"]
-        service = result["service"]
-        date = result["date"]
+            combo_id = result["combo_id"]
+            customer_id = result["customer_id"]
+            customer_name = result["name"]
+            customer_email = result["email"]
+            service = result["service"]
+            date = result["date"]
 
-        print(f"Debug: Attempting to Delete Combo ID {appointment_id}")
+            logger.debug("Attempting to delete appointment ID %s", appointment_id)
 
-        # Delete the appointment
-        cursor.execute("DELETE FROM appointments WHERE id = ?", (appointment_id,))
-        if cursor.rowcount == 0:
-            print(f"Error: Failed to Delte Appointment {appointment_id}")
-            return False
-        conn.commit()
+            # Delete the appointment
+            cursor.execute("DELETE FROM appointments WHERE id = ?", (appointment_id,))
+            if cursor.rowcount == 0:
+                print(f"Error: Failed to Delte Appointment {appointment_id}")
+                return False
 
-        print(f"Debug: Appointment ID {appointment_id} deleted successfully")
+            # Restore combo usage if applicable, in the same transaction as the delete
+            if combo_id:
+                cursor.execute("UPDATE combos SET remaining_uses = remaining_uses + 1 WHERE id = ?", (combo_id,))
 
-        # Restore combo usage if applicable
-        remaining_uses = None
-        if combo_id:
-            cursor.execute("UPDATE combos SET remaining_uses = remaining_uses + 1 WHERE id = ?", (combo_id,))
             conn.commit()
+            invalidate_customer_combos(customer_id)
 
-            # Fetch updated remaining uses
-            cursor.execute("SELECT remaining_uses FROM combos WHERE id = ?", (combo_id,))
-            updated_combo = cursor.fetchone()
-            remaining_uses = updated_combo["remaining_uses"] if updated_combo else None
-
-        # Send cancellation email AFTER appointment deletion
-        if customer_email and combo_id:
-            send_appointment_cancellation(
-                customer_id=customer_id,
-                customer_name=customer_name,
-                customer_email=customer_email,
-                service=service,
-                date=date
-            )
-
-        return True
+            logger.debug("Appointment ID %s deleted successfully", appointment_id)
     except Exception as e:
         print(f"Error deleting appointment: {e}")
         return False
-    finally:
-        conn.close()
+
+    # Send cancellation email AFTER appointment deletion, once the database writer is released
+    if customer_email and combo_id:
+        send_appointment_cancellation(
+            customer_id=customer_id,
+            customer_name=customer_name,
+            customer_email=customer_email,
+            service=service,
+            date=date
+        )
+
+    return True
 
 
 #function not used as of now, considered for future development
@@ -209,23 +201,21 @@ def edit_appointment(appointment_id, new_date, new_service_id):
     Returns:
         bool: True if successfully updated, False otherwise.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
     try:
-        # Update the appointment
-        cursor.execute(
-            "UPDATE appointments SET date = ?, service_id = ? WHERE id = ?",
-            (new_date, new_service_id, appointment_id)
-        )
-        conn.commit()
-        if cursor.rowcount > 0:
-            print(f"Appointment ID {appointment_id} updated to new date {new_date} and service ID {new_service_id}.")
-            return True
-        else:
-            print(f"No appointment found with ID {appointment_id}.")
-            return False
+        with write_conn() as conn:
+            cursor = conn.cursor()
+            # Update the appointment
+            cursor.execute(
+                "UPDATE appointments SET date = ?, service_id = ? WHERE id = ?",
+                (new_date, new_service_id, appointment_id)
+            )
+            conn.commit()
+            if cursor.rowcount > 0:
+                print(f"Appointment ID {appointment_id} updated to new date {new_date} and service ID {new_service_id}.")
+                return True
+            else:
+                print(f"No appointment found with ID {appointment_id}.")
+                return False
     except Exception as e:
         print(f"Error updating appointment: {e}")
         return False
-    finally:
-        conn.close()
@@ -1,200 +1,463 @@
+import json
+import logging
+import queue
 import sqlite3
+import threading
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+
+from cachetools import TTLCache
 
 # Path to the SQLite database file
 DB_PATH = 'database/business.db'
 
+# Number of read-only connections kept open for SELECT queries
+READ_POOL_SIZE = 4
+
+# Applied once to the read-write connection
+WRITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+)
+
+# Applied once to every connection
+DB_PRAGMAS = (
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-64000",
+)
+
+# Applied once to the read-write connection so existing databases pick up newer indexes
+DB_MIGRATIONS = (
+    # Covers the active-combo lookups by customer without touching the table
+    "CREATE INDEX IF NOT EXISTS idx_combos_cust ON combos (customer_id, remaining_uses, combo_type_id)",
+    "DROP INDEX IF EXISTS idx_combos_customer_remaining",  # Superseded by idx_combos_cust
+    "DROP INDEX IF EXISTS idx_combos_customer_id",  # A prefix of idx_combos_cust
+)
+
+# Statement texts are kept constant so each connection's statement cache reuses the compiled query
+STATEMENT_CACHE_SIZE = 256
+
+SQL_GET_COMBO_TYPE_BY_NAME = "SELECT id FROM combo_types WHERE name = ?"
+SQL_ADD_COMBO_TYPE = "INSERT INTO combo_types (name, total_uses) VALUES (?, ?)"
+SQL_ADD_COMBO_SERVICE = "INSERT INTO combo_services (combo_type_id, service_id) VALUES (?, ?)"
+SQL_ADD_COMBO_SERVICE_BY_NAME = """INSERT INTO combo_services (combo_type_id, service_id)
+                                   SELECT id, ? FROM combo_types WHERE name = ?"""
+# Each combo type with its services aggregated into a JSON array of {"id", "name"} objects
+SQL_GET_COMBO_TYPES = """
+    SELECT ct.id, ct.name, ct.total_uses,
+           json_group_array(json_object('id', s.id, 'name', s.name)) FILTER (WHERE s.id IS NOT NULL) AS services
+    FROM combo_types ct
+    LEFT JOIN combo_services cs ON cs.combo_type_id = ct.id
+    LEFT JOIN services s ON s.id = cs.service_id
+    GROUP BY ct.id
+    ORDER BY ct.id
+"""
+SQL_GET_SERVICES = "SELECT id, name FROM services"
+SQL_DELETE_COMBO_SERVICES = "DELETE FROM combo_services WHERE combo_type_id = ?"
+SQL_DELETE_COMBO_TYPE = "DELETE FROM combo_types WHERE id = ?"
+SQL_ADD_COMBO = """INSERT INTO combos (customer_id, combo_type_id, remaining_uses)
+                   SELECT ?, id, total_uses FROM combo_types WHERE id = ?"""
+SQL_GET_CUST_COMBOS = "SELECT id, combo_type_id, remaining_uses FROM combos WHERE customer_id = ? AND remaining_uses > 0"
+SQL_DEC_USES = """UPDATE combos SET remaining_uses = remaining_uses - 1
+                  WHERE id = ? AND remaining_uses > 0
+                  RETURNING id, customer_id, combo_type_id, remaining_uses"""
+
+logger = logging.getLogger(__name__)
+
+_conn = None
+_conn_lock = threading.Lock()
+_write_lock = threading.Lock()
+_read_pool = None
+_borrowed = threading.local()
+
+# Combo types keyed by id. Writers bump _cache_version after committing;
+# the cache is only trusted while _cached_version matches it.
+_combo_types_cache = {}
+_cache_version = 0
+_cached_version = None
+_cache_lock = threading.Lock()
+
+# Active combos per customer, kept for a couple of seconds so the lookups repeated
+# within one user action skip the database. Whoever commits a combo change invalidates it,
+# bumping the customer's generation (or the epoch, for the whole cache); a reader only stores
+# what it loaded if neither changed while it was loading.
+_combos_cache = TTLCache(maxsize=1024, ttl=2)
+_combos_generations = {}
+_combos_epoch = 0
+_combos_cache_lock = threading.Lock()
+
 # ============================
 # Helper Function
 # ============================
 
 def get_db_connection():
-    """Provides a single database connection with timeout."""
-    conn = sqlite3.connect(DB_PATH, timeout=30)
-    conn.row_factory = sqlite3.Row  # Makes query results more readable
+    """Provides the shared read-write database connection, opening it on first use."""
+    global _conn
+    if _conn is None:
+        with _conn_lock:
+            if _conn is None:
+                # isolation_level=None leaves transactions to write_conn(), which opens them explicitly
+                conn = sqlite3.connect(
+                    DB_PATH, timeout=30, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE,
+                    isolation_level=None
+                )
+                conn.row_factory = sqlite3.Row  # Makes query results more readable
+                for pragma in WRITE_PRAGMAS + DB_PRAGMAS:
+                    conn.execute(pragma)
+                for migration in DB_MIGRATIONS:
+                    conn.execute(migration)
+                _conn = conn
+    return _conn
+
+def _open_read_connection():
+    """Opens a read-only connection to the database."""
+    uri = Path(DB_PATH).resolve().as_uri() + "?mode=ro"
+    conn = sqlite3.connect(
+        uri, uri=True, timeout=30, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE
+    )
+    conn.row_factory = sqlite3.Row
+    for pragma in DB_PRAGMAS:
+        conn.execute(pragma)
     return conn
 
+def _get_read_pool():
+    """Provides the pool of read-only connections, filling it on first use."""
+    global _read_pool
+    if _read_pool is None:
+        get_db_connection()  # The writer switches the database to WAL before readers attach
+        with _conn_lock:
+            if _read_pool is None:
+                pool = queue.Queue(maxsize=READ_POOL_SIZE)
+                for _ in range(READ_POOL_SIZE):
+                    pool.put(_open_read_connection())
+                _read_pool = pool
+    return _read_pool
+
+@contextmanager
+def read_conn(shared=True):
+    """
+    Borrows a read-only connection from the pool for the duration of the block. Generators pass
+    shared=False: they may be resumed or closed on another thread, so their connection is neither
+    taken from nor lent to other reads on the current thread.
+    """
+    conn = getattr(_borrowed, "conn", None) if shared else None
+    if conn is not None:
+        # Nested reads on the same thread share the connection already borrowed
+        yield conn
+        return
+
+    pool = _get_read_pool()
+    conn = pool.get()
+    if shared:
+        _borrowed.conn = conn
+    try:
+        yield conn
+    finally:
+        if shared:
+            _borrowed.conn = None
+        pool.put(conn)
+
+@contextmanager
+def write_conn():
+    """
+    Holds the read-write connection for the duration of the block inside a BEGIN IMMEDIATE
+    transaction, so the write lock is taken up front. Anything left uncommitted is rolled back.
+    """
+    with _write_lock:
+        conn = get_db_connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+
+def backup_db(dest_path):
+    """Copies a consistent snapshot of the live database, including recent writes, to dest_path."""
+    dest = sqlite3.connect(dest_path)
+    try:
+        with _write_lock:
+            get_db_connection().backup(dest)
+    finally:
+        dest.close()
+
+def restore_db(src_path):
+    """
+    Replaces the contents of the live database with the database at src_path. The copy goes through
+    the open connection, so connections already open keep working and see the restored data.
+    """
+    src = sqlite3.connect(src_path)
+    try:
+        with _write_lock:
+            conn = get_db_connection()
+            src.backup(conn)
+            for migration in DB_MIGRATIONS:
+                conn.execute(migration)
+    finally:
+        src.close()
+
+    # Everything cached came from the old data
+    _invalidate_combo_types()
+    _clear_customer_combos()
+
+# ============================
+# Combo Types Cache
+# ============================
+
+def _invalidate_combo_types():
+    """Marks the cached combo types as stale. Call after committing a combo type change."""
+    global _cache_version
+    with _cache_lock:
+        _cache_version += 1
+
+def _get_combo_types_by_id(conn=None):
+    """
+    Returns combo types keyed by id, reloading them if a combo type changed since the last load.
+    A reload runs on the given connection, so callers holding the writer never wait on the read pool.
+    """
+    global _combo_types_cache, _cached_version
+    with _cache_lock:
+        if _cached_version == _cache_version:
+            return _combo_types_cache
+        version = _cache_version
+
+    with read_conn() if conn is None else nullcontext(conn) as conn:
+        rows = conn.execute(SQL_GET_COMBO_TYPES).fetchall()
+    # Services are parsed once here, so lookups afterwards are plain list operations
+    combo_types = {
+        row["id"]: {
+            "id": row["id"],
+            "name": row["name"],
+            "total_uses": row["total_uses"],
+            "services": json.loads(row["services"])
+        }
+        for row in rows
+    }
+
+    with _cache_lock:
+        # Only keep the result if no combo type was written while it loaded
+        if version == _cache_version:
+            _combo_types_cache = combo_types
+            _cached_version = version
+    return combo_types
+
 # ============================
 # Combo Types Management
 # ============================
 
 def add_combo_type(name, services, total_uses):
     """Adds a new combo type and associates it with selected services."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
     try:
-        # Check if the combo already exists
-        cursor.execute("SELECT id FROM combo_types WHERE name = ?", (name,))
-        existing_combo = cursor.fetchone()
-        if existing_combo:
-            print(f"Error: Combo type '{name}' already exists.")
-            return False
-
-        # Insert the combo type
-        cursor.execute(
-            "INSERT INTO combo_types (name, total_uses) VALUES (?, ?)",
-            (name, total_uses)
-        )
-        combo_type_id = cursor.lastrowid
-
-        # Insert the services linked to the combo
-        for service_id in services:
-            cursor.execute(
-                "INSERT INTO combo_services (combo_type_id, service_id) VALUES (?, ?)",
-                (combo_type_id, service_id)
-            )
+        with write_conn() as conn:
+            cursor = conn.cursor()
+            # Check if the combo already exists
+            cursor.execute(SQL_GET_COMBO_TYPE_BY_NAME, (name,))
+            existing_combo = cursor.fetchone()
+            if existing_combo:
+                print(f"Error: Combo type '{name}' already exists.")
+                return False
+
+            # Insert the combo type
+            cursor.execute(SQL_ADD_COMBO_TYPE, (name, total_uses))
+            combo_type_id = cursor.lastrowid
 
-        conn.commit()
-        print(f"Combo type '{name}' added successfully!")
-        return True
+            # Insert the services linked to the combo
+            cursor.executemany(SQL_ADD_COMBO_SERVICE, [(combo_type_id, service_id) for service_id in services])
+
+            conn.commit()
+            _invalidate_combo_types()
+            print(f"Combo type '{name}' added successfully!")
+            return True
     except Exception as e:
         print(f"Error adding combo type: {e}")
         return False
-    finally:
-        conn.close()
+
+def add_combo_types_bulk(rows):
+    """Adds several combo types in a single transaction. Each row is (name, service_ids, total_uses)."""
+    rows = list(rows)
+    try:
+        with write_conn() as conn:
+            cursor = conn.cursor()
+            cursor.executemany(SQL_ADD_COMBO_TYPE, [(name, total_uses) for name, _, total_uses in rows])
+
+            # Link services by combo name, since executemany does not report each new id
+            cursor.executemany(
+                SQL_ADD_COMBO_SERVICE_BY_NAME,
+                [(service_id, name) for name, services, _ in rows for service_id in services]
+            )
+
+            conn.commit()
+            _invalidate_combo_types()
+            print(f"{len(rows)} combo types added successfully!")
+            return True
+    except Exception as e:
+        print(f"Error adding combo types: {e}")
+        return False
 
 def get_combo_types():
     """Retrieves all available combo types."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
     try:
-        cursor.execute("SELECT * FROM combo_types")
-        combo_types = cursor.fetchall()
-
-        return [
-            {"id": combo["id"], "name": combo["name"], "total_uses": combo["total_uses"]}
-            for combo in combo_types
-        ]
+        return list(_get_combo_types_by_id().values())
     except Exception as e:
         print(f"Error retrieving combo types: {e}")
         return []
-    finally:
-        conn.close()
 
 def get_services_for_combo(combo_type_id=None):
     """Retrieves all services or services linked to a specific combo type."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
     try:
         if combo_type_id:
-            cursor.execute(
-                """SELECT s.id, s.name FROM services s
-                   JOIN combo_services cs ON s.id = cs.service_id
-                   WHERE cs.combo_type_id = ?""",
-                (combo_type_id,)
-            )
-        else:
-            cursor.execute("SELECT id, name FROM services")
-        
-        services = [{"id": row["id"], "name": row["name"]} for row in cursor.fetchall()]
-        return services
+            combo_type = _get_combo_types_by_id().get(combo_type_id)
+            return [dict(service) for service in combo_type["services"]] if combo_type else []
+
+        with read_conn() as conn:
+            return [dict(service) for service in conn.execute(SQL_GET_SERVICES)]
     except Exception as e:
         print(f"Error retrieving services for combo: {e}")
         return []
-    finally:
-        conn.close()
         
 def delete_combo_type(combo_type_id):
     """Deletes a combo type from the system, including its service mappings."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
     try:
-        # Delete services mapped to this combo
-        cursor.execute("DELETE FROM combo_services WHERE combo_type_id = ?", (combo_type_id,))
-
-        # Delete the combo type
-        cursor.execute("DELETE FROM combo_types WHERE id = ?", (combo_type_id,))
-        conn.commit()
-        print(f"Combo type ID {combo_type_id} deleted successfully!")
-        return True
+        with write_conn() as conn:
+            cursor = conn.cursor()
+            # Delete services mapped to this combo
+            cursor.execute(SQL_DELETE_COMBO_SERVICES, (combo_type_id,))
+
+            # Delete the combo type
+            cursor.execute(SQL_DELETE_COMBO_TYPE, (combo_type_id,))
+            conn.commit()
+            _invalidate_combo_types()
+            _clear_customer_combos()  # Cached customer combos carry the combo type names
+            print(f"Combo type ID {combo_type_id} deleted successfully!")
+            return True
     except Exception as e:
         print(f"Error deleting combo type: {e}")
         return False
-    finally:
-        conn.close()
 
 # ============================
 # Customer Combo Management
 # ============================
 
 def add_combo(customer_id, combo_type_id, conn=None):
-    """Assigns a combo to a customer using a shared connection if provided."""
-    should_close_connection = False
-    if conn is None:
-        conn = get_db_connection()
-        should_close_connection = True
-
-    cursor = conn.cursor()
+    """Assigns a combo to a customer. If a connection is provided, the caller commits the transaction."""
+    owns_transaction = conn is None
     try:
-        # Retrieve total uses from the combo_types table
-        cursor.execute("SELECT total_uses FROM combo_types WHERE id = ?", (combo_type_id,))
-        result = cursor.fetchone()
-        if not result:
-            print(f"Error: Combo type ID {combo_type_id} does not exist.")
-            return False
-        total_uses = result["total_uses"]
-
-        # Add combo to the combos table
-        cursor.execute(
-            "INSERT INTO combos (customer_id, combo_type_id, remaining_uses) VALUES (?, ?, ?)",
-            (customer_id, combo_type_id, total_uses)
-        )
-        conn.commit()
-        print(f"Combo for customer ID {customer_id} added successfully!")
-        return True
+        with write_conn() if owns_transaction else nullcontext(conn) as conn:
+            cursor = conn.cursor()
+            # Add combo to the combos table, starting from the combo type's total uses
+            cursor.execute(SQL_ADD_COMBO, (customer_id, combo_type_id))
+            if cursor.rowcount == 0:
+                print(f"Error: Combo type ID {combo_type_id} does not exist.")
+                return False
+
+            if owns_transaction:
+                conn.commit()
+                invalidate_customer_combos(customer_id)
+            print(f"Combo for customer ID {customer_id} added successfully!")
+            return True
     except Exception as e:
         print(f"Error adding combo: {e}")
         return False
-    finally:
-        if should_close_connection:
-            conn.close()
+
+def _fetch_customer_combos(conn, customer_id):
+    """Reads a customer's active combos on the given connection."""
+    combos = conn.execute(SQL_GET_CUST_COMBOS, (customer_id,)).fetchall()
+
+    # Fill in the combo type details from the cache instead of joining combo_types
+    combo_types = _get_combo_types_by_id(conn)
+    if any(combo["combo_type_id"] not in combo_types for combo in combos):
+        # Another process added a combo type this cache has not seen, so reload once
+        _invalidate_combo_types()
+        combo_types = _get_combo_types_by_id(conn)
+    return [
+        {
+            "id": combo["id"],
+            "name": combo_types[combo["combo_type_id"]]["name"],
+            "remaining_uses": combo["remaining_uses"],
+            "total_uses": combo_types[combo["combo_type_id"]]["total_uses"]
+        }
+        for combo in combos if combo["combo_type_id"] in combo_types
+    ]
+
+def _combos_version(customer_id):
+    """Returns what a customer's cached combos are checked against. Call with _combos_cache_lock held."""
+    return _combos_epoch, _combos_generations.get(customer_id, 0)
+
+def invalidate_customer_combos(customer_id):
+    """Drops a customer's cached combos. Call after committing a change to their combos."""
+    with _combos_cache_lock:
+        _combos_generations[customer_id] = _combos_generations.get(customer_id, 0) + 1
+        _combos_cache.pop(customer_id, None)
+
+def _clear_customer_combos():
+    """Drops every customer's cached combos. Call after committing a change that affects them all."""
+    global _combos_epoch
+    with _combos_cache_lock:
+        _combos_epoch += 1
+        _combos_cache.clear()
 
 def get_customer_combos(customer_id):
     """Retrieves all active combos for a specific customer (remaining uses > 0)."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    with _combos_cache_lock:
+        combos = _combos_cache.get(customer_id)
+        version = _combos_version(customer_id)
+    if combos is not None:
+        return [dict(combo) for combo in combos]  # Copies, so callers cannot change the cached entry
+
     try:
-        cursor.execute("""
-            SELECT c.id, ct.name, c.remaining_uses, ct.total_uses
-            FROM combos c
-            JOIN combo_types ct ON c.combo_type_id = ct.id
-            WHERE c.customer_id = ? AND c.remaining_uses > 0
-        """, (customer_id,))
-        
-        combos = cursor.fetchall()
-        return [
-            {"id": combo["id"], "name": combo["name"], "remaining_uses": combo["remaining_uses"], "total_uses": combo["total_uses"]}
-            for combo in combos
-        ]
+        with read_conn() as conn:
+            combos = _fetch_customer_combos(conn, customer_id)
     except Exception as e:
         print(f"Error retrieving customer combos: {e}")
         return []
-    finally:
-        conn.close()
+
+    with _combos_cache_lock:
+        # A combo change committed while this loaded may not be in it, so it is not kept
+        if version == _combos_version(customer_id):
+            _combos_cache[customer_id] = [dict(combo) for combo in combos]
+    return combos
 
 def update_combo_usage(combo_id, conn=None):
-    """Decreases the remaining uses of a combo by 1."""
-    should_close_connection = False
-    if conn is None:
-        conn = get_db_connection()
-        should_close_connection = True
+    """
+    Decreases the remaining uses of a combo by 1 and returns the updated combo row
+    (id, customer_id, combo_type_id, remaining_uses), or None if nothing was updated.
+    If a connection is provided, the caller commits the transaction.
+    """
+    owns_transaction = conn is None
+    try:
+        with write_conn() if owns_transaction else nullcontext(conn) as conn:
+            cursor = conn.cursor()
+            cursor.execute(SQL_DEC_USES, (combo_id,))
+            updated_combo = cursor.fetchone()  # RETURNING rows must be read before committing
+            if owns_transaction:
+                conn.commit()
+                if updated_combo:
+                    invalidate_customer_combos(updated_combo["customer_id"])
 
-    cursor = conn.cursor()
+            if updated_combo:
+                logger.debug("Combo ID %s usage updated successfully", combo_id)
+                return updated_combo
+            else:
+                print(f"Error: Combo ID {combo_id} has no remaining uses or does not exist.")
+                return None
+    except Exception as e:
+        print(f"Error updating combo usage: {e}")
+        return None
+
+def update_combo_usage_and_fetch(combo_id, customer_id, conn=None):
+    """
+    Decreases the remaining uses of a combo by 1 and, in the same transaction, reads the customer's
+    active combos. Returns (ok, combos). If a connection is provided, the caller commits the transaction.
+    """
+    owns_transaction = conn is None
     try:
-        cursor.execute(
-            "UPDATE combos SET remaining_uses = remaining_uses - 1 WHERE id = ? AND remaining_uses > 0",
-            (combo_id,)
-        )
-        conn.commit()
-
-        if cursor.rowcount > 0:
-            print(f"Debug: Combo ID {combo_id} usage updated successfully!")
-            return True
-        else:
-            print(f"Error: Combo ID {combo_id} has no remaining uses or does not exist.")
-            return False
+        with write_conn() if owns_transaction else nullcontext(conn) as conn:
+            updated_combo = update_combo_usage(combo_id, conn)
+            combos = _fetch_customer_combos(conn, customer_id)
+            if owns_transaction:
+                conn.commit()
+                invalidate_customer_combos(customer_id)
+            return updated_combo is not None, combos
     except Exception as e:
         print(f"Error updating combo usage: {e}")
-        return False
-    finally:
-        if should_close_connection:
-            conn.close()
+        return False, []
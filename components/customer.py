@@ -1,7 +1,21 @@
 import sqlite3
 import csv
+import logging
 import os
-from components.combo import add_combo, get_customer_combos, get_db_connection
+from itertools import chain, groupby
+from components.combo import add_combo, get_customer_combos, invalidate_customer_combos, read_conn, write_conn
+
+logger = logging.getLogger(__name__)
+
+# Every customer with their active combos, one row per combo (or a single row with NULL combo columns)
+SQL_GET_CUSTOMERS_WITH_COMBOS = """
+    SELECT c.id AS customer_id, c.name, c.phone, c.email,
+           co.id AS combo_id, ct.name AS combo_name, co.remaining_uses, ct.total_uses
+    FROM customers c
+    LEFT JOIN (combos co JOIN combo_types ct ON ct.id = co.combo_type_id)
+        ON co.customer_id = c.id AND co.remaining_uses > 0
+    ORDER BY c.id, co.id
+"""
 
 # ============================
 # Customer Management
@@ -9,232 +23,235 @@ from components.combo import add_combo, get_customer_combos, get_db_connection
 
 def add_customer(name, phone, email, combo_type_id):
     """Adds a new customer and assigns an initial combo to them."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
     try:
-        # Add customer to the database
-        cursor.execute("INSERT INTO customers (name, phone, email) VALUES (?, ?, ?)", (name, phone, email))
-        customer_id = cursor.lastrowid  # Get the new customer ID
+        with write_conn() as conn:
+            # Customer and combo are committed together, or not at all
+            with conn:
+                cursor = conn.cursor()
 
-        print(f"Debug: Customer '{name}' added with ID {customer_id}")
+                # Add customer to the database
+                cursor.execute("INSERT INTO customers (name, phone, email) VALUES (?, ?, ?)", (name, phone, email))
+                customer_id = cursor.lastrowid  # Get the new customer ID
 
-        # Assign the initial combo
-        if not add_combo(customer_id, combo_type_id, conn):
-            raise Exception("Failed to add combo for the customer.")
+                logger.debug("Customer '%s' added with ID %s", name, customer_id)
 
-        conn.commit()
-        print(f"Customer '{name}' added successfully with combo type ID {combo_type_id}!")
-        return True
+                # Assign the initial combo
+                if not add_combo(customer_id, combo_type_id, conn):
+                    raise Exception("Failed to add combo for the customer.")
+
+            print(f"Customer '{name}' added successfully with combo type ID {combo_type_id}!")
+            return True
     except sqlite3.IntegrityError:
         print(f"Error: Customer with phone number '{phone}' or email '{email}' already exists.")
         return False
     except Exception as e:
         print(f"Error adding customer: {e}")
         return False
-    finally:
-        conn.close()
 
 def get_customer_by_phone(phone):
     """Retrieves a customer's information using their phone number only."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
     try:
-        cursor.execute("SELECT * FROM customers WHERE phone = ?", (phone,))
-        customer = cursor.fetchone()
+        with read_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM customers WHERE phone = ?", (phone,))
+            customer = cursor.fetchone()
         
-        if not customer:
-            print(f"Debug: No customer found for phone number '{phone}'")
-            return None  # No customer found
-
-        customer_id = customer["id"]
-        customer_combos = get_customer_combos(customer_id)
-
-        print(f"Debug: Retrieved Customer {customer_id}: {customer}")
-        print(f"Debug: Customer {customer_id} Combos: {customer_combos}")
-
-        return {
-            "ID": customer_id,
-            "Name": customer["name"],
-            "Phone": customer["phone"],
-            "Email": customer["email"],
-            "Combos": customer_combos  # List of active combos
-        }
-    except Exception as e:
-        print(f"Error retrieving customer: {e}")
-        return None
-    finally:
-        conn.close()
-
-def get_all_customers():
-    """Retrieves all customers and their assigned combos."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute("SELECT * FROM customers")
-        customers = cursor.fetchall()
-
-        print(f"Debug: Retrieved Customers from DB: {customers}")
+            if not customer:
+                logger.debug("No customer found for phone number '%s'", phone)
+                return None  # No customer found
 
-        customer_list = []
-        for customer in customers:
             customer_id = customer["id"]
             customer_combos = get_customer_combos(customer_id)
 
-            customer_list.append({
+            customer_data = {
                 "ID": customer_id,
                 "Name": customer["name"],
                 "Phone": customer["phone"],
                 "Email": customer["email"],
-                "Combos": customer_combos
-            })
+                "Combos": customer_combos  # List of active combos
+            }
+            logger.debug("Retrieved Customer %s: %s", customer_id, customer_data)
+            return customer_data
+    except Exception as e:
+        print(f"Error retrieving customer: {e}")
+        return None
+
+def iter_customers(batch=200):
+    """
+    Yields customers and their assigned combos one at a time, reading rows from the
+    database in batches so large customer lists are never held in memory at once.
 
+    Exhaust or close() the generator when done: until then it holds a pooled connection
+    and an open read transaction, which keeps the write-ahead log from being checkpointed.
+    """
+    with read_conn(shared=False) as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(SQL_GET_CUSTOMERS_WITH_COMBOS)
+
+            def rows():
+                while batch_rows := cursor.fetchmany(batch):
+                    yield from batch_rows
+
+            for customer_id, customer_rows in groupby(rows(), key=lambda row: row["customer_id"]):
+                customer_rows = list(customer_rows)
+                customer = customer_rows[0]
+
+                yield {
+                    "ID": customer_id,
+                    "Name": customer["name"],
+                    "Phone": customer["phone"],
+                    "Email": customer["email"],
+                    "Combos": [
+                        {"id": row["combo_id"], "name": row["combo_name"], "remaining_uses": row["remaining_uses"], "total_uses": row["total_uses"]}
+                        for row in customer_rows if row["combo_id"] is not None
+                    ]
+                }
+        finally:
+            cursor.close()  # Ends the read transaction before the connection goes back to the pool
+
+def get_all_customers():
+    """Retrieves all customers and their assigned combos. Prefer iter_customers for large lists."""
+    try:
+        customer_list = list(iter_customers())
+        logger.debug("Retrieved %d customers from DB", len(customer_list))
         return customer_list
     except Exception as e:
         print(f"Error retrieving customers: {e}")
         return []
-    finally:
-        conn.close()
 
 def edit_customer(customer_id, new_name, new_email):
     """Edits a customer's name and updates their Email Address, but keeps phone number fixed."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
     try:
-        # Ensure customer exists
-        cursor.execute("SELECT name FROM customers WHERE id = ?", (customer_id,))
-        customer = cursor.fetchone()
-
-        if not customer:
-            print(f"Error: Customer ID {customer_id} not found.")
-            return False
+        with write_conn() as conn:
+            cursor = conn.cursor()
+            # Ensure customer exists
+            cursor.execute("SELECT name FROM customers WHERE id = ?", (customer_id,))
+            customer = cursor.fetchone()
+
+            if not customer:
+                print(f"Error: Customer ID {customer_id} not found.")
+                return False
         
-        #check if email already exisits in the system
-        cursor.execute("SELECT id FROM customers WHERE email = ? and id != ?", (new_email, customer_id))
-        existing_customer = cursor.fetchone()
-
-        if existing_customer:
-            print(f"Error: Email '{new_email} is already in use by another customer")
-            return "email_exists"
-
-        # Perform the update (phone number is NOT updated)
-        cursor.execute(
-            """UPDATE customers 
-               SET name = ?, email = ? 
-               WHERE id = ?""",
-            (new_name, new_email, customer_id)
-        )
-
-        conn.commit()
-        print(f"Customer ID {customer_id} updated successfully!")
-        return True
+            #check if email already exisits in the system
+            cursor.execute("SELECT id FROM customers WHERE email = ? and id != ?", (new_email, customer_id))
+            existing_customer = cursor.fetchone()
+
+            if existing_customer:
+                print(f"Error: Email '{new_email} is already in use by another customer")
+                return "email_exists"
+
+            # Perform the update (phone number is NOT updated)
+            cursor.execute(
+                """UPDATE customers 
+                   SET name = ?, email = ? 
+                   WHERE id = ?""",
+                (new_name, new_email, customer_id)
+            )
+
+            conn.commit()
+            print(f"Customer ID {customer_id} updated successfully!")
+            return True
 
     except Exception as e:
         print(f"Error updating customer: {e}")
         return False
-    finally:
-        conn.close()
 
-def delete_customer(customer_id):
-    """Deletes a customer and all related records (appointments, combos)."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+def delete_customer(customer_id, only_if_combos_used_up=False):
+    """
+    Deletes a customer and all related records (appointments, combos). With only_if_combos_used_up,
+    the customer is kept if they still have a combo with remaining uses.
+    """
     try:
-        # Ensure customer exists
-        cursor.execute("SELECT id FROM customers WHERE id = ?", (customer_id,))
-        customer = cursor.fetchone()
-        if not customer:
-            print(f"Error: Customer ID {customer_id} does not exist.")
-            return False
-
-        # Delete all appointments associated with the customer
-        cursor.execute("DELETE FROM appointments WHERE customer_id = ?", (customer_id,))
-        print(f"Deleted all appointments for Customer ID {customer_id}.")
-
-        # Delete all combos associated with the customer
-        cursor.execute("DELETE FROM combos WHERE customer_id = ?", (customer_id,))
-        print(f"Deleted all combos for Customer ID {customer_id}.")
-
-        # Delete customer from the database
-        cursor.execute("DELETE FROM customers WHERE id = ?", (customer_id,))
-        conn.commit()
-
-        print(f"Customer ID {customer_id} deleted successfully!")
-        return True
+        with write_conn() as conn:
+            cursor = conn.cursor()
+            # Ensure customer exists
+            cursor.execute("SELECT id FROM customers WHERE id = ?", (customer_id,))
+            customer = cursor.fetchone()
+            if not customer:
+                print(f"Error: Customer ID {customer_id} does not exist.")
+                return False
+
+            # Checked in the same transaction as the delete, so no combo can be added in between
+            if only_if_combos_used_up:
+                cursor.execute(
+                    "SELECT EXISTS(SELECT 1 FROM combos WHERE customer_id = ? AND remaining_uses > 0 LIMIT 1)",
+                    (customer_id,)
+                )
+                if cursor.fetchone()[0]:
+                    return False
+
+            # Delete all appointments associated with the customer
+            cursor.execute("DELETE FROM appointments WHERE customer_id = ?", (customer_id,))
+            print(f"Deleted all appointments for Customer ID {customer_id}.")
+
+            # Delete all combos associated with the customer
+            cursor.execute("DELETE FROM combos WHERE customer_id = ?", (customer_id,))
+            print(f"Deleted all combos for Customer ID {customer_id}.")
+
+            # Delete customer from the database
+            cursor.execute("DELETE FROM customers WHERE id = ?", (customer_id,))
+            conn.commit()
+            invalidate_customer_combos(customer_id)
+
+            print(f"Customer ID {customer_id} deleted successfully!")
+            return True
 
     except Exception as e:
         print(f"Error deleting customer: {e}")
         return False
-    finally:
-        conn.close()
 
 def remove_customer_if_combos_used_up(customer_id):
     """Checks if a customer has any remaining combos and deletes them if all combos are used up."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute(
-            "SELECT COUNT(*) FROM combos WHERE customer_id = ? AND remaining_uses > 0",
-            (customer_id,)
-        )
-        active_combos_count = cursor.fetchone()[0]
-        if active_combos_count == 0:
-            return delete_customer(customer_id)  # Now this checks for active combos before deletion
-        return False
-    except Exception as e:
-        print(f"Error checking customer combos: {e}")
-        return False
-    finally:
-        conn.close()
+    return delete_customer(customer_id, only_if_combos_used_up=True)
 
 
 def add_combo_to_existing_customer(customer_id, combo_type_id):
     """Adds a new combo to an existing customer."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
     try:
-        # Ensure customer exists
-        cursor.execute("SELECT id FROM customers WHERE id = ?", (customer_id,))
-        customer = cursor.fetchone()
-        if not customer:
-            print(f"Error: Customer ID {customer_id} does not exist.")
-            return False
-
-        # Add the new combo
-        if not add_combo(customer_id, combo_type_id, conn):
-            raise Exception("Failed to add the new combo.")
-
-        conn.commit()
-        print(f"New combo (ID {combo_type_id}) added for Customer ID {customer_id} successfully!")
-        return True
+        with write_conn() as conn:
+            cursor = conn.cursor()
+            # Ensure customer exists
+            cursor.execute("SELECT id FROM customers WHERE id = ?", (customer_id,))
+            customer = cursor.fetchone()
+            if not customer:
+                print(f"Error: Customer ID {customer_id} does not exist.")
+                return False
+
+            # Add the new combo
+            if not add_combo(customer_id, combo_type_id, conn):
+                raise Exception("Failed to add the new combo.")
+
+            conn.commit()
+            invalidate_customer_combos(customer_id)
+            print(f"New combo (ID {combo_type_id}) added for Customer ID {customer_id} successfully!")
+            return True
     except Exception as e:
         print(f"Error adding combo: {e}")
         return False
-    finally:
-        conn.close()
 
 
 def remove_combo_from_customer(customer_id, combo_id):
     """Removes a specific combo from a customer's profile."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
     try:
-        # Ensure combo exists for the customer
-        cursor.execute("SELECT id FROM combos WHERE id = ? AND customer_id = ?", (combo_id, customer_id))
-        combo = cursor.fetchone()
-        if not combo:
-            print(f"Error: Combo ID {combo_id} not found for Customer ID {customer_id}.")
-            return False
-
-        # Delete the combo
-        cursor.execute("DELETE FROM combos WHERE id = ?", (combo_id,))
-        conn.commit()
-        print(f"Combo ID {combo_id} removed from Customer ID {customer_id}.")
-        return True
+        with write_conn() as conn:
+            cursor = conn.cursor()
+            # Ensure combo exists for the customer
+            cursor.execute("SELECT id FROM combos WHERE id = ? AND customer_id = ?", (combo_id, customer_id))
+            combo = cursor.fetchone()
+            if not combo:
+                print(f"Error: Combo ID {combo_id} not found for Customer ID {customer_id}.")
+                return False
+
+            # Delete the combo
+            cursor.execute("DELETE FROM combos WHERE id = ?", (combo_id,))
+            conn.commit()
+            invalidate_customer_combos(customer_id)
+            print(f"Combo ID {combo_id} removed from Customer ID {customer_id}.")
+            return True
     except Exception as e:
         print(f"Error removing combo: {e}")
         return False
-    finally:
-        conn.close()
 
 
 def export_customers_to_csv():
@@ -244,16 +261,15 @@ def export_customers_to_csv():
     Returns:
         str: Path of the exported CSV file.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
     try:
-        # Retrieve all customers and their assigned combos
-        cursor.execute("SELECT id, name, email, phone FROM customers")
-        customers = cursor.fetchall()
+        # Stream customers and their assigned combos straight into the file
+        customers = iter_customers()
+        first_customer = next(customers, None)
 
-        if not customers:
+        if first_customer is None:
             print("No customers found for export.")
             return None
+        customers = chain([first_customer], customers)
 
         csv_filename = "customers_data.csv"
         csv_filepath = os.path.join(os.getcwd(), csv_filename)
@@ -263,13 +279,7 @@ def export_customers_to_csv():
             writer.writerow(["Customer ID", "Customer Name", "Email", "Ph.no", "Combos for the customer", "Remaining uses"])
 
             for customer in customers:
-                customer_id = customer["id"]
-                name = customer["name"]
-                email = customer["email"]
-                phone = customer["phone"]
-
-                # Fetch combos for the customer
-                customer_combos = get_customer_combos(customer_id)
+                customer_combos = customer["Combos"]
                 if customer_combos:
                     combo_names = ", ".join([combo["name"] for combo in customer_combos])
                     remaining_uses = ", ".join([str(combo["remaining_uses"]) for combo in customer_combos])
@@ -277,7 +287,7 @@ def export_customers_to_csv():
                     combo_names = "No combos"
                     remaining_uses = "N/A"
 
-                writer.writerow([customer_id, name, email, phone, combo_names, remaining_uses])
+                writer.writerow([customer["ID"], customer["Name"], customer["Email"], customer["Phone"], combo_names, remaining_uses])
 
         print(f"Customer data exported successfully: {csv_filepath}")
         return csv_filepath
@@ -285,5 +295,3 @@ def export_customers_to_csv():
     except Exception as e:
         print(f"Error exporting customers to CSV: {e}")
         return None
-    finally:
-        conn.close()
\ No newline at end of file
@@ -1,15 +1,53 @@
+import atexit
+import html
+import logging
 import smtplib
 import streamlit as st
 import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from email.message import EmailMessage
+from functools import lru_cache
 from components.combo import get_customer_combos 
 
+logger = logging.getLogger(__name__)
+
 # Load secrets from Streamlit's secrets manager
 SMTP_SERVER = st.secrets["EMAIL_HOST"]  # Fetch from Streamlit secrets
 SMTP_PORT = int(st.secrets["EMAIL_PORT"])  # Convert to int
 EMAIL_ADDRESS = st.secrets["EMAIL_USER"]  # Fetch email user
 EMAIL_PASSWORD = st.secrets["EMAIL_PASS"]  # Fetch email password
 
+# Matches {{KEY}} placeholders in email templates
+PLACEHOLDER_PATTERN = re.compile(r"\{\{(\w+)\}\}")
+
+# Markup wrapped around the combo rows in notification emails
+COMBO_TABLE_HEADER = """
+    <table border="1" cellpadding="5" cellspacing="0">
+        <tr>
+            <th>Combo Name</th>
+            <th>Remaining Uses</th>
+        </tr>
+"""
+COMBO_TABLE_FOOTER = """
+    </table>"""
+
+# Logged-in SMTP session shared by all sends, guarded by _smtp_lock
+_smtp = None
+_smtp_lock = threading.Lock()
+
+# Notification emails are sent in the background so bookings do not wait on SMTP
+_mail_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="mail")
+
+
+@lru_cache(maxsize=None)
+def _read_template(template_name):
+    """Reads an email template from disk once per process."""
+    template_path = os.path.join("templates", template_name)
+    with open(template_path, "r", encoding="utf-8") as file:
+        return file.read()
+
 
 def load_email_template(template_name, placeholders):
     """
@@ -22,18 +60,74 @@ def load_email_template(template_name, placeholders):
     Returns:
         str: The formatted email content.
     """
-    template_path = os.path.join("templates", template_name)
     try:
-        with open(template_path, "r", encoding="utf-8") as file:
-            template = file.read()
-        for key, value in placeholders.items():
-            template = template.replace(f"{{{{{key}}}}}", str(value))
-        return template
+        template = _read_template(template_name)
+        # Unknown placeholders are left untouched
+        return PLACEHOLDER_PATTERN.sub(
+            lambda match: str(placeholders.get(match.group(1), match.group(0))), template
+        )
     except FileNotFoundError:
         print(f"Error: Email template '{template_name}' not found.")
         return None
 
 
+def _get_smtp():
+    """Returns the shared SMTP session, connecting and logging in if needed. Call with _smtp_lock held."""
+    global _smtp
+    if _smtp is None:
+        smtp = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=30)
+        try:
+            smtp.ehlo()  # Identify ourselves to the SMTP server
+            smtp.starttls()  # Secure the connection
+            smtp.login(EMAIL_ADDRESS, EMAIL_PASSWORD)  # Log in
+        except Exception:
+            smtp.close()
+            raise
+        _smtp = smtp
+    return _smtp
+
+
+def _is_disconnect(error):
+    """Whether an SMTP error means the server closed the session, e.g. Gmail's "421 4.4.2 Timeout"."""
+    return isinstance(error, smtplib.SMTPServerDisconnected) or (
+        isinstance(error, smtplib.SMTPResponseException) and error.smtp_code == 421
+    )
+
+
+def _get_live_smtp():
+    """Returns the shared SMTP session after checking it with NOOP, reconnecting if it has gone stale. Call with _smtp_lock held."""
+    smtp = _get_smtp()
+    try:
+        if smtp.noop()[0] == 250:
+            return smtp
+    except (smtplib.SMTPException, OSError):
+        pass
+    _drop_smtp()
+    return _get_smtp()
+
+
+def _drop_smtp():
+    """Discards the shared SMTP session. Call with _smtp_lock held."""
+    global _smtp
+    if _smtp is not None:
+        _smtp.close()
+        _smtp = None
+
+
+def close_smtp():
+    """Politely ends the shared SMTP session, if one is open."""
+    with _smtp_lock:
+        if _smtp is not None:
+            try:
+                _smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            _drop_smtp()
+
+
+atexit.register(close_smtp)
+
+
 def send_email(subject, to_email, email_body):
     """
     Sends an email using the configured SMTP server.
@@ -58,12 +152,15 @@ def send_email(subject, to_email, email_body):
         email["Subject"] = subject
         email.set_content(email_body, subtype="html")  # Send HTML email
 
-        # Connect to Gmail SMTP Server
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as smtp:
-            smtp.ehlo()  # Identify ourselves to the SMTP server
-            smtp.starttls()  # Secure the connection
-            smtp.login(EMAIL_ADDRESS, EMAIL_PASSWORD)  # Log in
-            smtp.send_message(email)  # Send the email
+        # Reuse the Gmail SMTP session, reconnecting once if the server closed it while idle
+        with _smtp_lock:
+            try:
+                _get_live_smtp().send_message(email)
+            except smtplib.SMTPException as e:
+                if not _is_disconnect(e):
+                    raise
+                _drop_smtp()
+                _get_smtp().send_message(email)
 
         print(f"Email sent successfully to {to_email}")
         return True
@@ -73,44 +170,51 @@ def send_email(subject, to_email, email_body):
         return False
 
 
-def format_combo_table(customer_id):
+def _queue_email(subject, to_email, email_body):
+    """Sends an email on the mail pool and logs it if the send fails. Returns the Future."""
+    def log_failure(future):
+        try:
+            if future.result():
+                return
+            logger.error("Failed to send '%s' email to %s", subject, to_email)
+        except Exception:
+            logger.exception("Failed to send '%s' email to %s", subject, to_email)
+
+    future = _mail_pool.submit(send_email, subject, to_email, email_body)
+    future.add_done_callback(log_failure)
+    return future
+
+
+def format_combo_table(customer_id=None, combos=None):
     """
-    Fetches the customer's combos and formats them as an HTML table.
+    Formats the customer's combos as an HTML table, fetching them if they are not provided.
 
     Args:
-        customer_id (int): The ID of the customer.
-        booked_combo_id (int, optional): The ID of the combo used for booking. Default is None.
+        customer_id (int, optional): The ID of the customer. Used when combos is not provided.
+        combos (list, optional): The customer's already-fetched active combos. Default is None.
 
     Returns:
         str: Formatted HTML table of customer's combos.
     """
-    combos = get_customer_combos(customer_id)
+    if combos is None:
+        combos = get_customer_combos(customer_id)
     if not combos:
         return "No active combos"
 
-    table_html = """
-    <table border="1" cellpadding="5" cellspacing="0">
-        <tr>
-            <th>Combo Name</th>
-            <th>Remaining Uses</th>
-        </tr>
-    """
-
-    for combo in combos:
-        table_html += f"""
+    rows = "".join(
+        f"""
         <tr>
-            <td>{combo["name"]}</td>
+            <td>{html.escape(combo["name"])}</td>
             <td>{combo["remaining_uses"]}</td>
-        </tr>
-        """
-
-    table_html += "</table>"
-    return table_html
+        </tr>"""
+        for combo in combos
+    )
+    return COMBO_TABLE_HEADER + rows + COMBO_TABLE_FOOTER
 
 
-def send_appointment_confirmation(customer_id, customer_name, customer_email, service, date, booked_combo_id):
+def send_appointment_confirmation(customer_id, customer_name, customer_email, service, date, booked_combo_id, combos=None):
     """
-    Sends an appointment confirmation email to the customer.
+    Queues an appointment confirmation email to the customer.
 
     Args:
         customer_name (str): The customer's name.
@@ -118,33 +222,15 @@ def send_appointment_confirmation(customer_id, customer_name, customer_email, se
         service (str): The booked service.
         date (str): The appointment date (YYYY-MM-DD).
         remaining_uses (int): The remaining uses in the combo.
-    """
-    combos = get_customer_combos(customer_id)
-
-    #Apply -1 for remaining uses due to email error (lazy way, need to work in future)
-    for combo in combos:
-        if combo["id"] == booked_combo_id:
-            combo["remaining_uses"] -= 1
-
-    # #Generate Table with updated values
-    # combo_table = """
-    # <table border = "1" cellpadding = "5" cellspacing = "0">
-    #     <tr>
-    #         <th>Combo Name</th>
-    #         <th>Remaining Uses</th>
-    #     </tr>
-    # """
-    # for combo in combos:
-    #     combo_table += f"""
-    #     <tr>
-    #         <td>{combo["name"]}</td>
-    #         <td>{combo["remaining_uses"]}</td>
-    #     </tr>
-    #     """
-    # combo_table += "</table>"
+        combos (list, optional): The customer's active combos after booking. Fetched if not provided.
 
-    #get latest combo data
-    combo_table = format_combo_table(customer_id)
+    Returns:
+        Future: Resolves to send_email's result, or None if the template could not be loaded.
+    """
+    #get latest combo data (the booking has already been committed, so it includes this appointment)
+    if combos is None:
+        combos = get_customer_combos(customer_id)
+    combo_table = format_combo_table(combos=combos)
 
     placeholders = {
         "CUSTOMER_NAME": customer_name,
@@ -154,12 +240,12 @@ def send_appointment_confirmation(customer_id, customer_name, customer_email, se
     }
     email_body = load_email_template("appointment_confirmation.html", placeholders)
     if email_body:
-        send_email("Appointment Confirmation - Ani's Threading & Skincare", customer_email, email_body)
+        return _queue_email("Appointment Confirmation - Ani's Threading & Skincare", customer_email, email_body)
 
 
 def send_appointment_cancellation(customer_id, customer_name, customer_email, service, date):
     """
-    Sends an appointment cancellation email to the customer.
+    Queues an appointment cancellation email to the customer.
 
     Args:
         customer_name (str): The customer's name.
@@ -167,6 +253,9 @@ def send_appointment_cancellation(customer_id, customer_name, customer_email, se
         service (str): The cancelled service.
         date (str): The appointment date (YYYY-MM-DD).
         remaining_uses (int): The restored combo uses.
+
+    Returns:
+        Future: Resolves to send_email's result, or None if the template could not be loaded.
     """
     #get latest combo data
     combo_table = format_combo_table(customer_id)
@@ -179,4 +268,4 @@ def send_appointment_cancellation(customer_id, customer_name, customer_email, se
     }
     email_body = load_email_template("appointment_cancellation.html", placeholders)
     if email_body:
-        send_email("Appointment Cancellation - Ani's Threading & Skincare", customer_email, email_body)
+        return _queue_email("Appointment Cancellation - Ani's Threading & Skincare", customer_email, email_body)
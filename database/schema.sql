@@ -66,7 +66,7 @@ CREATE TABLE IF NOT EXISTS appointments (
 -- Indexes for Optimization
 -- ============================
 CREATE INDEX IF NOT EXISTS idx_customers_phone ON customers (phone);
-CREATE INDEX IF NOT EXISTS idx_combos_customer_id ON combos (customer_id);
+CREATE INDEX IF NOT EXISTS idx_combos_cust ON combos (customer_id, remaining_uses, combo_type_id);
 CREATE INDEX IF NOT EXISTS idx_appointments_customer_id ON appointments (customer_id);
 CREATE INDEX IF NOT EXISTS idx_appointments_date ON appointments (date);
 CREATE INDEX IF NOT EXISTS idx_services_name ON services (name);